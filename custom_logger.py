@@ -6,29 +6,250 @@ __maintainer__ = "Adam Kippenhan"
 __license__ = "MIT"
 __status__ = "Production"
 
-from datetime import datetime
-from inspect import getframeinfo, stack
+import os
+import sys
+import time
+import weakref
 from pathlib import Path
-from typing import Union
+from typing import Callable, Dict, List, Optional, TextIO, Tuple, Union
+
+# Log level names as they appear in log messages.
+_ERROR = "ERROR"
+_INFO = "INFO"
+_DEBUG = "DEBUG"
+
+# Numeric values of the log levels, used to skip messages below the minimum
+# level set by the LOG_LEVEL environment variable. WARNING and WARN are
+# accepted as values of LOG_LEVEL, which only lets error messages through.
+_ERROR_NO = 40
+_INFO_NO = 20
+_DEBUG_NO = 10
+_LEVELS = {
+    _ERROR: _ERROR_NO,
+    "WARNING": 30,
+    "WARN": 30,
+    _INFO: _INFO_NO,
+    _DEBUG: _DEBUG_NO,
+}
+
+# Thresholds at which buffered log messages are written out.
+_BUF_MAX_LINES = 64
+_BUF_MAX_BYTES = 8192
+_BUF_MAX_AGE = 1.0
+
+# The size of the write buffer for log files.
+_FILE_BUFFER_SIZE = 65536
+
+# Open log files and the number of loggers using each one, keyed by absolute
+# path. Loggers writing to the same file share one handle so that messages from
+# different loggers are written in order despite the large write buffer.
+_log_files: Dict[str, Tuple[TextIO, int]] = {}
+
+
+def _write_stdout(output: str) -> int:
+    """Write to stdout, looking it up on each call so redirection is honored.
+
+    Parameters
+    ----------
+    output : str
+        The text to write.
+
+    Returns
+    -------
+    int
+        The number of characters written.
+    """
+    return sys.stdout.write(output)
+
+
+def _open_log_file(path: str) -> TextIO:
+    """Get the shared handle for a log file, opening it if needed.
+
+    Parameters
+    ----------
+    path : str
+        The absolute path of the log file.
+
+    Returns
+    -------
+    TextIO
+        The handle to write log messages to.
+    """
+    fh, users = _log_files.get(path, (None, 0))
+    if fh is None:
+        fh = open(path, "a", buffering=_FILE_BUFFER_SIZE, encoding="utf-8")
+    _log_files[path] = (fh, users + 1)
+    return fh
+
+
+def _release(buf: List[str], write: Callable[[str], int], path: Optional[str]):
+    """Write out a logger's buffered log messages and release its log file.
+
+    The log file is closed once no logger is using it any more. This is run by
+    a finalizer, so it must not hold a reference to the logger.
+
+    Parameters
+    ----------
+    buf : List[str]
+        The buffered log messages of the logger.
+    write : Callable[[str], int]
+        The function the logger writes log messages with.
+    path : Optional[str]
+        The absolute path of the log file of the logger, or None if logging to
+        stdout.
+    """
+    if buf:
+        write("".join(buf))
+        buf.clear()
+    if path is not None:
+        fh, users = _log_files.pop(path)
+        if users > 1:
+            _log_files[path] = (fh, users - 1)
+            fh.flush()
+        else:
+            fh.close()
 
 
 class CustomLogger:
     """A custom class to perform logging."""
 
-    def __init__(self, log_file: Union[Path, str] = "stdout"):
+    # The formatted date and time of the most recently logged second, shared
+    # between all instances so it only has to be rebuilt once per second.
+    _ts_sec = 0
+    _ts_prefix = ""
+    # The formatted date and hour of the current local hour and the range of
+    # epoch seconds it covers, so that local time only has to be looked up
+    # once per hour. Refreshing hourly rather than daily keeps timestamps
+    # correct across daylight saving time changes.
+    _ts_hour_prefix = ""
+    _ts_hour_start = 0
+    _ts_hour_end = 0
+
+    def __init__(self, log_file: Union[Path, str] = "stdout", buffered: bool = False):
         """Initialize a CustomLogger object.
 
         Parameters
         ----------
         log_file : Union[Path, str], optional
             The file to log to. If a value of "stdout" is given (case
-            insensitive), log messages will print to stdout. Defaults to
-            "stdout".
+            insensitive), log messages will print to stdout. Log files are
+            written through a buffer, shared by all loggers writing to the
+            same file, which is flushed whenever an error is logged, when
+            flush() is called and when the logger is closed, including at
+            interpreter exit. Defaults to "stdout".
+        buffered : bool, optional
+            Whether or not to collect log messages in memory and write them
+            out in batches. Buffered messages are written out once enough of
+            them have been collected, when a message is logged more than a
+            second after the oldest buffered one, whenever an error is logged,
+            when flush() is called and when the logger is closed. There is no
+            background flushing, so on an idle logger messages stay buffered
+            until one of these happens. Messages from several
+            buffered loggers writing to the same file may therefore be written
+            out of order. Defaults to False.
         """
+        # Unknown values of LOG_LEVEL fall back to logging everything.
+        self.level = _LEVELS.get(
+            os.environ.get("LOG_LEVEL", _DEBUG).strip().upper(), _DEBUG_NO
+        )
         self.log_file = log_file
         self.stdout = (
             True if type(log_file) is str and log_file.lower() == "stdout" else False
         )
+        self._fh = None
+        path = None
+        if self.stdout:
+            self._write = _write_stdout
+        else:
+            path = os.path.abspath(log_file)
+            self._fh = _open_log_file(path)
+            self._write = self._fh.write
+        self._buffered = buffered
+        self._buf = []
+        self._buf_bytes = 0
+        self._buf_started = 0.0
+        # Make sure that nothing is lost when the logger is garbage collected
+        # or still open at exit, without keeping the logger alive.
+        self._finalizer = weakref.finalize(self, _release, self._buf, self._write, path)
+
+    def flush(self):
+        """Write out any buffered log messages.
+
+        Log files are written through a large buffer, so this should be called
+        when log messages need to be on disk before the logger is closed.
+        """
+        if self._buf:
+            output = "".join(self._buf)
+            self._buf.clear()
+            self._buf_bytes = 0
+            self._write(output)
+        if self._fh is not None and not self._fh.closed:
+            self._fh.flush()
+
+    def close(self):
+        """Write out any buffered log messages and close the log file.
+
+        The log file is only closed once every logger writing to it has been
+        closed. The logger must not be used after it has been closed.
+        """
+        self._finalizer()
+
+    @classmethod
+    def _update_ts_prefix(cls, sec: int):
+        """Update the cached timestamp prefix to a new second.
+
+        Parameters
+        ----------
+        sec : int
+            The epoch second to format the timestamp prefix for.
+        """
+        if not cls._ts_hour_start <= sec < cls._ts_hour_end:
+            tm = time.localtime(sec)
+            cls._ts_hour_prefix = (
+                f"{tm.tm_year:04d}-{tm.tm_mon:02d}-{tm.tm_mday:02d} {tm.tm_hour:02d}:"
+            )
+            cls._ts_hour_start = sec - tm.tm_min * 60 - tm.tm_sec
+            cls._ts_hour_end = cls._ts_hour_start + 3600
+        minutes, seconds = divmod(sec - cls._ts_hour_start, 60)
+        cls._ts_prefix = f"{cls._ts_hour_prefix}{minutes:02d}:{seconds:02d}"
+        cls._ts_sec = sec
+
+    def _emit(self, level_str: str, message: str):
+        """Format and write a log message.
+
+        This must only be called directly from one of the public log level
+        methods so that the caller's frame is two levels up the stack.
+
+        Parameters
+        ----------
+        level_str : str
+            The name of the log level of the message.
+        message : str
+            The message to log.
+        """
+        frame = sys._getframe(2)
+        function = frame.f_code.co_name
+        if function == "<module>":
+            function = "main"
+        now = time.time()
+        sec = int(now)
+        if sec != CustomLogger._ts_sec:
+            CustomLogger._update_ts_prefix(sec)
+        ts = f"{CustomLogger._ts_prefix},{int((now - sec) * 1000):03d}"
+        output = f"{ts} [{level_str} {function} {frame.f_lineno}] {message}\n"
+        if self._buffered:
+            if not self._buf:
+                self._buf_started = now
+            self._buf.append(output)
+            self._buf_bytes += len(output)
+            if (
+                len(self._buf) >= _BUF_MAX_LINES
+                or self._buf_bytes >= _BUF_MAX_BYTES
+                or now - self._buf_started >= _BUF_MAX_AGE
+            ):
+                self.flush()
+        else:
+            self._write(output)
 
     def error(self, message: str):
         """Write an error log message.
@@ -38,13 +259,9 @@ class CustomLogger:
         message : str
             The message to log.
         """
-        frame_info = getframeinfo(stack()[1][0])
-        output = f"{datetime.now().strftime('%Y-%m-%d %H:%M:%S,%f')[:-3]} [ERROR {frame_info.function.replace('<module>', 'main')} {frame_info.lineno}] {message}\n"
-        if self.stdout:
-            print(output, end="")
-        else:
-            with open(self.log_file, "a+") as f:
-                f.write(output)
+        if _ERROR_NO >= self.level:
+            self._emit(_ERROR, message)
+            self.flush()
 
     def info(self, message: str):
         """Write an info log message.
@@ -54,13 +271,8 @@ class CustomLogger:
         message : str
             The message to log.
         """
-        frame_info = getframeinfo(stack()[1][0])
-        output = f"{datetime.now().strftime('%Y-%m-%d %H:%M:%S,%f')[:-3]} [INFO {frame_info.function.replace('<module>', 'main')} {frame_info.lineno}] {message}\n"
-        if self.stdout:
-            print(output, end="")
-        else:
-            with open(self.log_file, "a+") as f:
-                f.write(output)
+        if _INFO_NO >= self.level:
+            self._emit(_INFO, message)
 
     def debug(self, message: str):
         """Write a debug log message.
@@ -70,10 +282,5 @@ class CustomLogger:
         message : str
             The message to log.
         """
-        frame_info = getframeinfo(stack()[1][0])
-        output = f"{datetime.now().strftime('%Y-%m-%d %H:%M:%S,%f')[:-3]} [DEBUG {frame_info.function.replace('<module>', 'main')} {frame_info.lineno}] {message}\n"
-        if self.stdout:
-            print(output, end="")
-        else:
-            with open(self.log_file, "a+") as f:
-                f.write(output)
+        if _DEBUG_NO >= self.level:
+            self._emit(_DEBUG, message)
@@ -6,19 +6,51 @@ __maintainer__ = "Adam Kippenhan"
 __license__ = "MIT"
 __status__ = "Production"
 
-from email import encoders
-from email.mime.base import MIMEBase
-from email.mime.multipart import MIMEMultipart
-from email.mime.text import MIMEText
+import atexit
+from base64 import encodebytes
+from contextlib import nullcontext
+from functools import lru_cache
+from io import BytesIO
 from os import remove
-from os.path import isfile
 from pathlib import Path
-from smtplib import SMTP
-from traceback import format_exc
-from typing import List, Optional, Tuple, Union
+from typing import TYPE_CHECKING, Dict, List, Optional, Tuple, Union
 
 from custom_logger import CustomLogger
 
+# The smtplib, email.mime and traceback modules are only imported when needed
+# to keep importing this module fast.
+if TYPE_CHECKING:
+    from email.mime.base import MIMEBase
+    from smtplib import SMTP
+
+# Attachments are read and base64 encoded in chunks of this many bytes. This is
+# a multiple of 57, the number of bytes encoded on each 76 character line, so
+# the encoded chunks join up into whole lines.
+_ATTACHMENT_CHUNK_SIZE = 57 * 1024
+
+# The MIME type and subtype of email attachments.
+_ATTACHMENT_CONTENT_TYPE = ("application", "octet-stream")
+
+# Logged in connections to the Gmail SMTP server, keyed by username.
+_smtp_connections: Dict[str, "SMTP"] = {}
+
+
+@lru_cache(maxsize=16)
+def _get_logger(log_file: Union[Path, str]) -> CustomLogger:
+    """Get the shared CustomLogger object for a log file.
+
+    Parameters
+    ----------
+    log_file : Union[Path, str]
+        The log file for the logger or stdout.
+
+    Returns
+    -------
+    CustomLogger
+        The logger for log_file.
+    """
+    return CustomLogger(log_file)
+
 
 def get_secrets(
     secrets_file: Path,
@@ -46,38 +78,201 @@ def get_secrets(
 
     Raises
     ------
+    OSError
+        If secrets_file cannot be read, such as FileNotFoundError if it does
+        not exist or IsADirectoryError if it is a directory.
     ValueError
         If username_tag or password_tag cannot be found in secrets_file.
     """
-    lg = CustomLogger(log_file)
+    lg = _get_logger(log_file)
     lg.info(f"Loading secrets for '{username_tag}' from '{secrets_file}'...")
 
-    if not isfile(secrets_file):
+    # Map each tag to the secrets it holds, which may be both if the tags are
+    # the same.
+    targets = {username_tag: ("username",)}
+    targets[password_tag] = targets.get(password_tag, ()) + ("password",)
+    result = {}
+    try:
+        data = Path(secrets_file).read_text()
+    except FileNotFoundError:
         lg.error(f"File '{secrets_file}' does not exist!")
-        raise Exception(f"File '{secrets_file}' does not exist!")
-
-    username = password = ""
-    with open(secrets_file, "r") as f:
-        for line in f:
-            if line.startswith(username_tag):
-                username = line.partition(":")[2].strip()
-            if line.startswith(password_tag):
-                password = line.partition(":")[2].strip()
-
-        # Ensure that username_tag and password_tag are present in secrets_file.
-        if username == "":
-            raise ValueError(
-                f"Username tag: '{username_tag}' not found in '{secrets_file}'!"
-            )
-        if password == "":
-            raise ValueError(
-                f"Password tag: '{password_tag}' not found in '{secrets_file}'!"
-            )
+        raise
+    except OSError as e:
+        lg.error(f"File '{secrets_file}' could not be read: {e}")
+        raise
+    for line in data.splitlines():
+        tag, _, value = line.partition(":")
+        slots = targets.get(tag.rstrip())
+        value = value.strip()
+        # Skip tags with blank values, such as ones left over from the template.
+        if slots and value:
+            for slot in slots:
+                result[slot] = value
+            # Stop parsing once both secrets have been found.
+            if len(result) == 2:
+                break
+    username = result.get("username", "")
+    password = result.get("password", "")
+
+    # Ensure that username_tag and password_tag are present in secrets_file.
+    if username == "":
+        raise ValueError(
+            f"Username tag: '{username_tag}' not found in '{secrets_file}'!"
+        )
+    if password == "":
+        raise ValueError(
+            f"Password tag: '{password_tag}' not found in '{secrets_file}'!"
+        )
 
     lg.info("Secrets loaded successfully!")
     return username, password
 
 
+def get_smtp(username: str, password: str) -> "SMTP":
+    """Get a logged in connection to the Gmail SMTP server.
+
+    Connections are cached per username and reused by later calls as long as
+    the server still responds, otherwise a new connection is made. Cached
+    connections are closed by close_smtp, which is also run at exit.
+
+    Parameters
+    ----------
+    username : str
+        The username to log in to the Gmail SMTP server with.
+    password : str
+        The password to log in to the Gmail SMTP server with.
+
+    Returns
+    -------
+    SMTP
+        A logged in connection to the Gmail SMTP server.
+
+    Raises
+    ------
+    BaseException
+        Any error raised while starting TLS or logging in, such as
+        SMTPAuthenticationError for invalid credentials. The new connection is
+        closed first.
+    """
+    from smtplib import SMTP, SMTPException
+
+    server = _smtp_connections.pop(username, None)
+    if server is not None:
+        try:
+            if server.noop()[0] == 250:
+                _smtp_connections[username] = server
+                return server
+        except (SMTPException, OSError):
+            pass
+        try:
+            server.close()
+        except OSError:
+            pass
+
+    # Only cache the connection once logged in, closing it if that fails.
+    server = SMTP("smtp.gmail.com", 587)
+    try:
+        server.starttls()
+        server.login(username, password)
+    except BaseException:
+        server.close()
+        raise
+    _smtp_connections[username] = server
+    return server
+
+
+def close_smtp():
+    """Close all connections to the Gmail SMTP server cached by get_smtp."""
+    # Only import smtplib if there is a connection to close, as this also runs
+    # at exit.
+    if _smtp_connections:
+        from smtplib import SMTPException
+
+        while _smtp_connections:
+            _, server = _smtp_connections.popitem()
+            try:
+                server.quit()
+            except (SMTPException, OSError):
+                server.close()
+
+
+atexit.register(close_smtp)
+
+
+def _create_attachment(attachment: Path) -> "MIMEBase":
+    """Create an email attachment from a file.
+
+    Parameters
+    ----------
+    attachment : Path
+        The file to attach.
+
+    Returns
+    -------
+    MIMEBase
+        The base64 encoded attachment.
+    """
+    from email.mime.base import MIMEBase
+
+    encoded = BytesIO()
+    with open(attachment, "rb") as f:
+        while chunk := f.read(_ATTACHMENT_CHUNK_SIZE):
+            encoded.write(encodebytes(chunk))
+    part = MIMEBase(*_ATTACHMENT_CONTENT_TYPE)
+    part.set_payload(encoded.getvalue().decode("ascii"))
+    part["Content-Transfer-Encoding"] = "base64"
+    part.add_header("Content-Disposition", "attachment", filename=attachment.name)
+    return part
+
+
+def _create_message(
+    username: str,
+    to_header: str,
+    subject: str,
+    body: str,
+    html: bool = False,
+    attachments: Optional[List["MIMEBase"]] = None,
+) -> str:
+    """Create an email and return it serialized as a string.
+
+    Parameters
+    ----------
+    username : str
+        The email address of the sender.
+    to_header : str
+        The comma separated email recipients.
+    subject : str
+        The subject of the email.
+    body : str
+        The body of the email.
+    html : bool, optional
+        Whether or not to encode the body as html. Defaults to False.
+    attachments : Optional[List[MIMEBase]]
+        A list of attachments created by _create_attachment. Defaults to None.
+
+    Returns
+    -------
+    str
+        The serialized email.
+    """
+    from email.mime.multipart import MIMEMultipart
+    from email.mime.text import MIMEText
+
+    message = text_part = MIMEText(body, "html" if html else "plain")
+
+    # A multipart email is only needed when there are attachments.
+    if attachments:
+        message = MIMEMultipart()
+        message.attach(text_part)
+        for part in attachments:
+            message.attach(part)
+
+    message["From"] = username
+    message["To"] = to_header
+    message["Subject"] = subject
+    return message.as_string()
+
+
 def send_email(
     recipients: List[str],
     subject: str,
@@ -88,6 +283,7 @@ def send_email(
     log_file: Union[Path, str] = "stdout",
     html: bool = False,
     attachments: Optional[List[Path]] = None,
+    smtp: Optional["SMTP"] = None,
 ):
     """Send an email using the Gmail SMTP server.
 
@@ -114,8 +310,13 @@ def send_email(
         Whether or not to encode the body as html. Defaults to False.
     attachments : Optional[List[Path]]
         A list of files to attach to the email. Defaults to None.
+    smtp : Optional[SMTP], optional
+        A logged in connection to the Gmail SMTP server to send the email
+        with, such as one returned by get_smtp. This avoids connecting and
+        logging in again when sending several emails. If None, a new
+        connection is made for this email only. Defaults to None.
     """
-    lg = CustomLogger(log_file)
+    lg = _get_logger(log_file)
 
     # Get the email credentials.
     username, password = get_secrets(
@@ -126,42 +327,119 @@ def send_email(
     )
 
     # Address the email to the sender if recipients is ["DEBUG"].
-    if recipients == ["DEBUG"]:
+    if len(recipients) == 1 and recipients[0] == "DEBUG":
         recipients = [username]
 
-    lg.info(f"Creating new email to recipient(s): {', '.join(recipients)}...")
-
-    message = MIMEMultipart()
-    message["From"] = username
-    message["To"] = ", ".join(recipients)
-    message["Subject"] = subject
-
-    message.attach(MIMEText(body, "html")) if html else message.attach(MIMEText(body))
+    to_header = ", ".join(recipients)
+    lg.info(f"Creating new email to recipient(s): {to_header}...")
 
     # Attach the given attachment(s) to the email.
+    parts = []
     if attachments is not None:
         for attachment in attachments:
             lg.debug(f"Attaching '{attachment}' to email....")
-            with open(attachment, "rb") as f:
-                part = MIMEBase("application", "octet-stream")
-                part.set_payload(f.read())
-            encoders.encode_base64(part)
-            part.add_header(
-                "Content-Disposition",
-                f"attachment; filename={attachment.name}",
-            )
-            message.attach(part)
-    text = message.as_string()
+            parts.append(_create_attachment(attachment))
+
+    text = _create_message(
+        username=username,
+        to_header=to_header,
+        subject=subject,
+        body=body,
+        html=html,
+        attachments=parts,
+    )
 
     # Send the email.
-    with SMTP("smtp.gmail.com", 587) as server:
-        server.starttls()
-        server.login(username, password)
-        server.sendmail(username, recipients, text)
+    if smtp is None:
+        from smtplib import SMTP
+
+        with SMTP("smtp.gmail.com", 587) as server:
+            server.starttls()
+            server.login(username, password)
+            server.sendmail(username, recipients, text)
+    else:
+        smtp.sendmail(username, recipients, text)
 
     lg.info("Email sent successfully!")
 
 
+def send_bulk(
+    messages: List[Tuple[List[str], str, str]],
+    secrets_file: Path,
+    username_tag: str = "gmail_username",
+    password_tag: str = "gmail_password",
+    log_file: Union[Path, str] = "stdout",
+    html: bool = False,
+    smtp: Optional["SMTP"] = None,
+):
+    """Send several emails over a single Gmail SMTP server session.
+
+    Parameters
+    ----------
+    messages : List[Tuple[List[str], str, str]]
+        A list of emails to send, each given as a tuple of its recipients,
+        subject and body. Recipients of ["DEBUG"] will address the email to the
+        sender.
+    secrets_file : Path
+        The file containing email credentials.
+    username_tag : str, optional
+        The tag for the email username in the secrets file. Defaults to
+        "gmail_username".
+    password_tag : str, optional
+        The tag for the email password in the secrets file. Defaults to
+        "gmail_password".
+    log_file : Union[Path, str], optional
+        The log file for this function or stdout. Defaults to "stdout".
+    html : bool, optional
+        Whether or not to encode the bodies as html. Defaults to False.
+    smtp : Optional[SMTP], optional
+        A logged in connection to the Gmail SMTP server to send the emails
+        with, such as one returned by get_smtp. If None, a new connection is
+        made for these emails only. Defaults to None.
+    """
+    lg = _get_logger(log_file)
+
+    # Get the email credentials.
+    username, password = get_secrets(
+        secrets_file=secrets_file,
+        username_tag=username_tag,
+        password_tag=password_tag,
+        log_file=log_file,
+    )
+
+    # Connect to the server unless a connection was given. A new connection is
+    # closed when done, even if logging in or sending fails.
+    if smtp is None:
+        from smtplib import SMTP
+
+        connection = SMTP("smtp.gmail.com", 587)
+    else:
+        connection = nullcontext(smtp)
+
+    # Send the emails, resetting the session state between each one.
+    with connection as server:
+        if smtp is None:
+            server.starttls()
+            server.login(username, password)
+        for recipients, subject, body in messages:
+            # Address the email to the sender if recipients is ["DEBUG"].
+            if len(recipients) == 1 and recipients[0] == "DEBUG":
+                recipients = [username]
+            to_header = ", ".join(recipients)
+            lg.info(f"Creating new email to recipient(s): {to_header}...")
+            text = _create_message(
+                username=username,
+                to_header=to_header,
+                subject=subject,
+                body=body,
+                html=html,
+            )
+            server.sendmail(username, recipients, text)
+            server.rset()
+
+    lg.info(f"{len(messages)} email(s) sent successfully!")
+
+
 def test_send_email(
     secrets_file: Path,
     username_tag: str = "gmail_username",
@@ -187,7 +465,7 @@ def test_send_email(
         Whether or not to include an attachment in the test email. Defaults to
         False.
     """
-    lg = CustomLogger(log_file)
+    lg = _get_logger(log_file)
 
     lg.info("====== INITIALIZING... ======")
 
@@ -211,6 +489,8 @@ def test_send_email(
             )
         # Catch any exceptions raised by send_email.
         except Exception as e:
+            from traceback import format_exc
+
             lg.error(f"Exception occurred: {e}\n{format_exc().strip()}")
         finally:
             # Remove the test attachment file.
@@ -229,6 +509,8 @@ def test_send_email(
             )
         # Catch any exceptions raised by send_email.
         except Exception as e:
+            from traceback import format_exc
+
             lg.error(f"Exception occurred: {e}\n{format_exc().strip()}")
 
     lg.info("====== TERMINATED ======")
@@ -346,7 +628,7 @@ if __name__ == "__main__":
 
     log_file = "stdout" if args.log_file == "stdout" else Path(args.log_file)
 
-    lg = CustomLogger(log_file)
+    lg = _get_logger(log_file)
 
     if args.option == "message":
         lg.info("====== INITIALIZING... ======")
@@ -355,16 +637,20 @@ if __name__ == "__main__":
                 "Recipients must be specified either in file or with --recipients option!"
             )
         if args.file:  # Read email contents from a file.
-            if not isfile(args.file):
+            try:
+                with open(args.file) as f:
+                    recipients = f.readline().strip().split(",")
+                    if not recipients[0]:
+                        lg.error(f"File '{args.file}' is empty!")
+                        raise Exception(f"File '{args.file}' is empty!")
+                    subject = f.readline().strip()
+                    body = f.read()
+            except FileNotFoundError:
                 lg.error(f"File '{args.file}' does not exist!")
-                raise Exception(f"File '{args.file}' does not exist!")
-            with open(args.file) as f:
-                recipients = f.readline().strip().split(",")
-                if not recipients[0]:
-                    lg.error(f"File '{args.file}' is empty!")
-                    raise Exception(f"File '{args.file}' is empty!")
-                subject = f.readline().strip()
-                body = f.read()
+                raise
+            except OSError as e:
+                lg.error(f"File '{args.file}' could not be read: {e}")
+                raise
         else:
             recipients = args.recipients
             subject = args.subject